@@ -1,7 +1,12 @@
 import os
+import json
 import pathlib
+import functools
+import shutil
+import tempfile
 import faiss
 import numpy as np
+import pyarrow as pa
 import google.generativeai as genai
 from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
@@ -14,112 +19,399 @@ BASE_DIR = pathlib.Path(__file__).resolve().parent
 VECTORSTORE_PATH = BASE_DIR / "vectorstore"
 load_dotenv()
 
+def atomic_write(path, write):
+    """Run write(tmp_path), then move the finished file onto path.
+
+    Every Uvicorn worker builds missing derived files at import, and
+    threads may persist concurrently; with a unique temp file (mkstemp, same
+    directory) plus os.replace, readers only ever see either no file or a
+    complete one.
+    """
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    os.close(fd)
+    tmp = pathlib.Path(tmp)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 if not GOOGLE_API_KEY:
     raise ValueError("❌ Missing GOOGLE_API_KEY")
 
 genai.configure(api_key=GOOGLE_API_KEY)
 
+# One shared client. No max_output_tokens: gemini-2.5-flash counts thinking
+# tokens against it and this SDK cannot set a thinking budget, so any cap
+# low enough to shorten decoding also truncates answers.
+# Static boilerplate is sent as the system instruction, ahead of and
+# byte-identical across every request, so it forms a stable prompt prefix;
+# prompts below carry only the per-request query and documents.
+GEMINI_SYSTEM_INSTRUCTION = (
+    "You are an expert mining assistant. "
+    "Answer concisely, factually, and directly."
+)
+GEMINI = genai.GenerativeModel(
+    "gemini-2.5-flash",
+    system_instruction=GEMINI_SYSTEM_INSTRUCTION,
+    generation_config=genai.GenerationConfig(temperature=0.2),
+)
+
 # Embeddings model
-embed_model = SentenceTransformer("all-MiniLM-L6-v2")
+EMBED_MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+ONNX_MODEL_DIR = BASE_DIR / "onnx_model"
+# SentenceTransformer's max_seq_length for MiniLM (not the tokenizer's 512);
+# the ONNX path must truncate identically to match the stored vectors.
+EMBED_MAX_SEQ_LENGTH = 256
+USE_ONNX = os.getenv("USE_ONNX", "1") == "1"
+USE_TORCH_COMPILE = os.getenv("USE_TORCH_COMPILE", "1") == "1"
+
+def load_onnx_encoder():
+    """Export MiniLM to ONNX, quantize it to dynamic INT8 and open a session.
+
+    The exported/quantized model is cached in ONNX_MODEL_DIR so the export
+    only happens on first start.
+    """
+    import onnxruntime as ort
+    from transformers import AutoTokenizer
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    quantized_path = ONNX_MODEL_DIR / "model_quantized.onnx"
+    if not quantized_path.exists():
+        # Export into a per-process temp dir and rename it into place, so
+        # workers starting together never load a half-written model.
+        tmp_dir = ONNX_MODEL_DIR.with_name(f".{ONNX_MODEL_DIR.name}.{os.getpid()}.tmp")
+        try:
+            model = ORTModelForFeatureExtraction.from_pretrained(EMBED_MODEL_ID, export=True)
+            model.save_pretrained(tmp_dir)
+            quantizer = ORTQuantizer.from_pretrained(model)
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=tmp_dir, quantization_config=qconfig)
+            try:
+                os.replace(tmp_dir, ONNX_MODEL_DIR)
+            except OSError:
+                # Another worker won the race; its export is just as good
+                if not quantized_path.exists():
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    sess_options = ort.SessionOptions()
+    sess_options.intra_op_num_threads = os.cpu_count()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = ort.InferenceSession(
+        str(quantized_path), sess_options, providers=["CPUExecutionProvider"]
+    )
+    tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL_ID)
+    return tokenizer, session
+
+embed_model = None
+onnx_tokenizer = onnx_session = None
+if USE_ONNX:
+    try:
+        onnx_tokenizer, onnx_session = load_onnx_encoder()
+        print("✅ Using ONNX Runtime INT8 embeddings")
+    except Exception as e:
+        print(f"⚠️ ONNX Runtime unavailable ({e}), falling back to PyTorch")
+
+if onnx_session is None:
+    import torch
+    torch.set_num_threads(os.cpu_count())
+    embed_model = SentenceTransformer(EMBED_MODEL_ID)
+
+    if USE_TORCH_COMPILE:
+        # Inductor fuses attention / LayerNorm+GELU into C++/OpenMP kernels.
+        # dynamic=True avoids a recompile for every new sequence length.
+        transformer = embed_model._first_module()
+        eager_model = transformer.auto_model
+        try:
+            transformer.auto_model = torch.compile(eager_model, backend="inductor", dynamic=True)
+            embed_model.encode(["warm up"])  # pay compile cost at startup
+            print("✅ Using torch.compile'd embeddings")
+        except Exception as e:
+            transformer.auto_model = eager_model
+            print(f"⚠️ torch.compile failed ({e}), using eager PyTorch")
 
 # ---------------------------
 # Load FAISS index + metadata
 # ---------------------------
 faiss_index_path = VECTORSTORE_PATH / "index.faiss"
 faiss_meta_path = VECTORSTORE_PATH / "index.pkl"
+faiss_ip_path = VECTORSTORE_PATH / "index_ip.faiss"
+
+# Flat index codes are mmap'd from the page cache (IO_FLAG_MMAP_IFC), so
+# every Uvicorn worker shares one copy of the vectors instead of holding its
+# own. Other index types (HNSW, IVF) are still loaded into process memory.
+MMAP_FLAGS = faiss.IO_FLAG_MMAP_IFC
+
+# Sub-linear search: flat stores above ANN_MIN_VECTORS are rebuilt once
+# with this factory string and cached next to the flat index.
+# HNSW32 keeps recall@5 near 1.0. For memory-bound stores, opt in to 4-bit
+# FastScan PQ with "IVF128,PQ48x4fs,RFlat": d/M=8 hits FAISS's hand-written
+# SIMD kernels (24 B/vector codes), and the RFlat stage re-ranks
+# REFINE_K_FACTOR*k candidates exactly, since PQ alone loses most of the recall.
+ANN_INDEX_FACTORY = os.getenv("FAISS_INDEX_FACTORY", "HNSW32")
+ANN_MIN_VECTORS = int(os.getenv("FAISS_ANN_MIN_VECTORS", "10000"))
+HNSW_EF_SEARCH = 64
+IVF_NPROBE = 8
+REFINE_K_FACTOR = 16
+# One cache file per factory, so changing the factory triggers a rebuild
+faiss_ann_path = VECTORSTORE_PATH / f"index_{ANN_INDEX_FACTORY.replace(',', '_').lower()}.faiss"
 
 if not faiss_index_path.exists():
     raise FileNotFoundError("❌ FAISS index not found. Run the vectorstore builder first.")
 
-# Load FAISS index
-index = faiss.read_index(str(faiss_index_path))
+def build_ann_index(vectors, factory=ANN_INDEX_FACTORY):
+    ann = faiss.index_factory(vectors.shape[1], factory, faiss.METRIC_INNER_PRODUCT)
+    if not ann.is_trained:
+        ann.train(vectors)
+    ann.add(vectors)
+    return ann
+
+def configure_search(idx):
+    if isinstance(idx, faiss.IndexRefine):
+        idx.k_factor = REFINE_K_FACTOR
+    if hasattr(idx, "hnsw"):
+        idx.hnsw.efSearch = HNSW_EF_SEARCH
+    try:
+        faiss.extract_index_ivf(idx).nprobe = IVF_NPROBE
+    except RuntimeError:
+        pass  # not an IVF index
+
+def is_fresh(derived, source):
+    # Derived files are rebuilt whenever the vectorstore they came from changes
+    return derived.exists() and derived.stat().st_mtime >= source.stat().st_mtime
+
+def write_and_remap(idx, path):
+    atomic_write(path, lambda tmp: faiss.write_index(idx, str(tmp)))
+    return faiss.read_index(str(path), MMAP_FLAGS)
+
+# Load FAISS index (derived indexes are cached next to the original)
+if is_fresh(faiss_ann_path, faiss_index_path):
+    index = faiss.read_index(str(faiss_ann_path), MMAP_FLAGS)
+elif is_fresh(faiss_ip_path, faiss_index_path):
+    index = faiss.read_index(str(faiss_ip_path), MMAP_FLAGS)
+else:
+    index = faiss.read_index(str(faiss_index_path), MMAP_FLAGS)
+
+    # Embeddings are unit-normalized, so inner product == cosine similarity.
+    # Convert legacy flat L2 indexes once and cache the result.
+    if isinstance(index, faiss.IndexFlatL2):
+        vectors = index.reconstruct_n(0, index.ntotal)
+        faiss.normalize_L2(vectors)
+        index = faiss.IndexFlatIP(index.d)
+        index.add(vectors)
+        index = write_and_remap(index, faiss_ip_path)
+        print(f"ℹ️ Converted IndexFlatL2 → IndexFlatIP → {faiss_ip_path.name}")
+
+if isinstance(index, faiss.IndexFlat) and index.ntotal >= ANN_MIN_VECTORS:
+    index = build_ann_index(index.reconstruct_n(0, index.ntotal))
+    index = write_and_remap(index, faiss_ann_path)
+    print(f"✅ Built {ANN_INDEX_FACTORY} index → {faiss_ann_path.name}")
+
+configure_search(index)
 
 # ------ FIXED, PERMANENT METADATA LOADING ------
-with open(faiss_meta_path, "rb") as f:
-    meta = pickle.load(f)
-
-documents = None
-
-# 1) Case: meta is a list
-if isinstance(meta, list):
-    documents = meta
-
-# 2) Case: meta is a tuple → scan inside
-elif isinstance(meta, tuple):
-    for item in meta:
-        if isinstance(item, list):
-            documents = item
-            break
-        if isinstance(item, dict) and "documents" in item:
-            documents = item["documents"]
-            break
-
-# 3) Case: meta is a dict with "documents" key
-elif isinstance(meta, dict):
-    if "documents" in meta:
-        documents = meta["documents"]
-
-# 4) Deep search fallback
-if documents is None:
-    def find_docs(obj):
-        if isinstance(obj, list) and all(isinstance(x, str) for x in obj):
-            return obj
-        if isinstance(obj, dict):
-            for v in obj.values():
-                found = find_docs(v)
-                if found:
-                    return found
-        if isinstance(obj, tuple):
-            for v in obj:
-                found = find_docs(v)
-                if found:
-                    return found
-        return None
-    documents = find_docs(meta)
-
-# 5) If still None → raise error
-if documents is None:
-    raise TypeError("❌ Could not locate any list of documents inside index.pkl. "
-                    "Rebuild the vectorstore.")
-
-print(f"✅ Loaded {len(documents)} documents from index.pkl")
-
-# ---------------------------
-# Utility: Embed a query
+# index.pkl is converted once to an Arrow IPC file, which is then memory-mapped:
+# no per-string Python objects at startup, and workers share the pages.
+docs_arrow_path = VECTORSTORE_PATH / "docs.arrow"
+
+def load_pickled_documents(path):
+    with open(path, "rb") as f:
+        meta = pickle.load(f)
+
+    documents = None
+
+    # 1) Case: meta is a list
+    if isinstance(meta, list):
+        documents = meta
+
+    # 2) Case: meta is a tuple → scan inside
+    elif isinstance(meta, tuple):
+        for item in meta:
+            if isinstance(item, list):
+                documents = item
+                break
+            if isinstance(item, dict) and "documents" in item:
+                documents = item["documents"]
+                break
+
+    # 3) Case: meta is a dict with "documents" key
+    elif isinstance(meta, dict):
+        if "documents" in meta:
+            documents = meta["documents"]
+
+    # 4) Deep search fallback
+    if documents is None:
+        def find_docs(obj):
+            if isinstance(obj, list) and all(isinstance(x, str) for x in obj):
+                return obj
+            if isinstance(obj, dict):
+                for v in obj.values():
+                    found = find_docs(v)
+                    if found:
+                        return found
+            if isinstance(obj, tuple):
+                for v in obj:
+                    found = find_docs(v)
+                    if found:
+                        return found
+            return None
+        documents = find_docs(meta)
+
+    # 5) If still None → raise error
+    if documents is None:
+        raise TypeError("❌ Could not locate any list of documents inside index.pkl. "
+                        "Rebuild the vectorstore.")
+
+    return documents
+
+def convert_metadata_to_arrow(src=faiss_meta_path, dst=docs_arrow_path):
+    docs = load_pickled_documents(src)
+    table = pa.table({"doc": pa.array(docs, type=pa.string())})
+
+    def write(tmp):
+        with pa.OSFile(str(tmp), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    atomic_write(dst, write)
+
+if not is_fresh(docs_arrow_path, faiss_meta_path):
+    convert_metadata_to_arrow()
+    print(f"ℹ️ Converted index.pkl → {docs_arrow_path.name}")
+
+documents = pa.ipc.open_file(pa.memory_map(str(docs_arrow_path), "r")).read_all().column("doc")
+
+def get_documents(ids):
+    # Materialise Python strings only for the hits, not all N documents
+    ids = [int(i) for i in ids if i != -1]
+    return documents.take(pa.array(ids, type=pa.int64())).to_pylist()
+
+print(f"✅ Loaded {len(documents)} documents from {docs_arrow_path.name}")
+
+# ---------------------------
+# Utility: Embed queries
 # ---------------------------
+EMBED_BATCH_SIZE = 32
+
+def onnx_encode(texts: list[str]):
+    # Sort by length so each chunk pads to a similar length (same trick
+    # SentenceTransformer.encode applies internally), then restore order.
+    order = np.argsort([len(t) for t in texts], kind="stable")
+    sorted_texts = [texts[i] for i in order]
+
+    input_names = {i.name for i in onnx_session.get_inputs()}
+    chunks = []
+    for start in range(0, len(sorted_texts), EMBED_BATCH_SIZE):
+        enc = onnx_tokenizer(
+            sorted_texts[start:start + EMBED_BATCH_SIZE],
+            padding=True,
+            truncation=True,
+            max_length=EMBED_MAX_SEQ_LENGTH,
+            return_tensors="np",
+        )
+        inputs = {k: v.astype(np.int64) for k, v in enc.items() if k in input_names}
+        token_emb = onnx_session.run(None, inputs)[0]
+
+        # Mean pooling over real tokens, then L2-normalize
+        mask = enc["attention_mask"][..., None].astype(np.float32)
+        pooled = (token_emb * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        chunks.append(pooled.astype(np.float32))
+    emb = np.vstack(chunks)
+    return np.ascontiguousarray(emb[np.argsort(order)])
+
+def embed_batch(texts: list[str]):
+    if onnx_session is not None:
+        return onnx_encode(texts)
+
+    # encode() already returns a contiguous float32 ndarray and length-sorts
+    # internally, so always hand it the whole list rather than looping
+    emb = embed_model.encode(
+        texts,
+        batch_size=EMBED_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+    )
+    return emb.reshape(len(texts), -1)
+
+@functools.lru_cache(maxsize=4096)
+def _embed_cached(text: str) -> bytes:
+    # bytes, not ndarray: hashable/immutable, so callers can't corrupt the cache
+    return embed_batch([text])[0].tobytes()
+
 def embed(text: str):
-    return np.array(embed_model.encode([text]), dtype=np.float32)
+    return np.frombuffer(_embed_cached(text), dtype=np.float32).reshape(1, -1)
 
 # ---------------------------
 # RAG Search
 # ---------------------------
-def search_faiss(query: str, k=5):
-    q_emb = embed(query)
+def search_faiss(query, k=5):
+    """Search one query (str) or a batch of queries (list[str]).
+
+    A batch is embedded and searched in a single call; the result is a
+    list of hit lists, one per query.
+    """
+    if isinstance(query, str):
+        q_emb = embed(query)  # memoized, shared with the semantic cache
+    else:
+        q_emb = embed_batch(list(query))
     distances, indices = index.search(q_emb, k)
-    hits = [documents[i] for i in indices[0] if i != -1]
-    return hits
+    hits = [get_documents(row) for row in indices]
+    return hits[0] if isinstance(query, str) else hits
 
 # ---------------------------
 # Generate Final Answer (Gemini)
 # ---------------------------
-def generate_answer(query: str, context_docs: list):
+def build_prompt(query: str, context_docs: list):
     context = "\n\n".join(context_docs)
 
-    prompt = f"""
-You are an expert mining assistant.
-
+    return f"""
 User question:
 {query}
 
 Relevant mining documents:
 {context}
-
-Answer concisely, factually, and directly.
 """
 
-    response = genai.GenerativeModel("gemini-2.5-flash").generate_content(prompt)
-    return response.text
+class PartialAnswer(str):
+    """Answer text Gemini cut off at its output limit (MAX_TOKENS).
+
+    Still worth showing the user, but callers must not cache it.
+    """
+
+def check_finished(response, has_text):
+    """True if complete, False if cut off at MAX_TOKENS with text; else raise."""
+    reason = response.candidates[0].finish_reason if response.candidates else None
+    name = getattr(reason, "name", str(reason))
+    if name == "STOP":
+        return True
+    if name == "MAX_TOKENS" and has_text:
+        return False
+    # SAFETY, RECITATION, empty MAX_TOKENS, ...: nothing usable to return
+    raise RuntimeError(f"❌ Gemini did not finish the answer (finish_reason={name})")
+
+def generate_answer(query: str, context_docs: list):
+    response = GEMINI.generate_content(build_prompt(query, context_docs))
+    has_text = bool(response.candidates and response.candidates[0].content.parts)
+    if check_finished(response, has_text):
+        return response.text
+    return PartialAnswer(response.text)
+
+def generate_answer_stream(query: str, context_docs: list):
+    """Yield text chunks; a final empty PartialAnswer marks a cut-off answer."""
+    response = GEMINI.generate_content(build_prompt(query, context_docs), stream=True)
+    has_text = False
+    for chunk in response:
+        if chunk.parts:
+            has_text = True
+            yield chunk.text
+    if not check_finished(response, has_text):
+        yield PartialAnswer("")
 
 # ---------------------------
 # Full RAG Pipeline
@@ -129,6 +421,62 @@ def ask(query: str):
     answer = generate_answer(query, context_docs)
     return answer
 
+def ask_stream(query: str):
+    context_docs = search_faiss(query, k=5)
+    yield from generate_answer_stream(query, context_docs)
+
+# ---------------------------
+# Batched RAG (one Gemini call for several items)
+# ---------------------------
+def build_batch_prompt(items: list, output_format: str, context_docs: list):
+    numbered = "\n\n".join(f"Item {i}:\n{item}" for i, item in enumerate(items, 1))
+    context = "\n\n".join(context_docs)
+
+    return f"""
+Handle each of the following {len(items)} items independently:
+{numbered}
+
+Relevant mining documents:
+{context}
+
+Return only a JSON array with exactly {len(items)} elements, one per item,
+in the same order. Each element must be {output_format}
+"""
+
+def parse_json_reply(text: str):
+    text = text.strip()
+    # Guard against ```json fences despite the JSON mime type
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    return json.loads(text)
+
+def ask_batch(items: list, output_format: str, q_embs=None):
+    """Answer several items with one retrieval pass and one Gemini call.
+
+    q_embs may carry the items' already-computed embeddings (e.g. from the
+    semantic cache) so they are not encoded again.
+    """
+    if q_embs is None or any(e is None for e in q_embs):
+        q_emb = embed_batch(items)
+    else:
+        q_emb = np.vstack(q_embs)
+    distances, indices = index.search(q_emb, 5)
+    # Union of every item's hits, de-duplicated, in rank order
+    context_docs = list(dict.fromkeys(doc for row in indices for doc in get_documents(row)))
+
+    response = GEMINI.generate_content(
+        build_batch_prompt(items, output_format, context_docs),
+        generation_config={"response_mime_type": "application/json"},
+    )
+    has_text = bool(response.candidates and response.candidates[0].content.parts)
+    if not check_finished(response, has_text):
+        raise ValueError("Batch reply was cut off at the output limit")
+    answers = parse_json_reply(response.text)
+    if not isinstance(answers, list) or len(answers) != len(items):
+        raise ValueError(f"Expected a JSON array of {len(items)} answers")
+    return answers
+
 # ---------------------------
 # CLI testing
 # ---------------------------
@@ -1,12 +1,26 @@
 import streamlit as st
 import requests
 import asyncio
+import json
+from requests.adapters import HTTPAdapter
 
 # ------------------------------
 # CONFIG
 # ------------------------------
 API_URL = "http://localhost:8000"  # Change if deployed
 
+@st.cache_resource
+def get_session():
+    # Streamlit reruns this script on every interaction; cache the session
+    # so its keep-alive pool survives across reruns.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=3)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+session = get_session()
+
 st.set_page_config(
     page_title="Digital Mine Safety Officer",
     page_icon="⛏️",
@@ -31,26 +45,26 @@ if section == "💬 Chat with AI":
     st.header("💬 Ask Mining Safety Questions")
     query = st.text_input("Enter your question:", "")
 
-    async def ask_query_async(query_text):
-        try:
-            response = await asyncio.to_thread(
-                lambda: requests.post(f"{API_URL}/query", json={"query": query_text})
-            )
-            if response.status_code == 200:
-                # Backend automatically handles L1/L2 caching
-                return response.json().get("response", "")
-            return "Server error."
-        except Exception as e:
-            return f"⚠️ Error: {e}"
+    def stream_query(query_text):
+        # Server-sent events: one JSON-encoded text chunk per "data:" line
+        with session.post(
+            f"{API_URL}/query/stream", json={"query": query_text}, stream=True
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if line and line.startswith("data: "):
+                    yield json.loads(line[len("data: "):])
 
     if st.button("Ask"):
         if not query.strip():
             st.warning("Please enter a question.")
         else:
-            with st.spinner("Thinking..."):
-                response_text = asyncio.run(ask_query_async(query))
-                st.success(response_text)
+            try:
+                # Backend automatically handles L1/L2 caching
+                st.write_stream(stream_query(query))
                 st.info("⚡ Response served from cache if repeated query (backend L1/L2 cache)")
+            except Exception as e:
+                st.error(f"⚠️ Error: {e}")
 
 # ============================================================
 # SECTION 2 — LIVE DGMS / MINING UPDATES
@@ -60,7 +74,7 @@ elif section == "📰 DGMS Updates":
 
     async def fetch_updates_async():
         try:
-            response = await asyncio.to_thread(lambda: requests.get(f"{API_URL}/updates"))
+            response = await asyncio.to_thread(lambda: session.get(f"{API_URL}/updates"))
             if response.status_code == 200:
                 return response.json().get("updates", [])
             return []
@@ -91,27 +105,31 @@ elif section == "📄 Audit Report PDF":
     year = st.text_input("Year:", "All Years")
     hazard_type = st.text_input("Hazard Type:", "All Hazards")
 
+    def download_pdf(state, year, hazard_type):
+        # st.download_button needs the whole file as bytes anyway
+        response = session.post(
+            f"{API_URL}/audit_report_pdf",
+            json={"state": state, "year": year, "hazard_type": hazard_type},
+        )
+        if response.status_code != 200:
+            return None
+        return response.content
+
     async def generate_pdf_async(state, year, hazard_type):
         try:
-            response = await asyncio.to_thread(
-                lambda: requests.post(
-                    f"{API_URL}/audit_report_pdf",
-                    json={"state": state, "year": year, "hazard_type": hazard_type},
-                )
-            )
-            return response
+            return await asyncio.to_thread(download_pdf, state, year, hazard_type)
         except Exception as e:
             st.error(f"⚠️ Error: {e}")
             return None
 
     if st.button("Generate PDF Report"):
         with st.spinner("Generating audit report..."):
-            response = asyncio.run(generate_pdf_async(state, year, hazard_type))
-            if response and response.status_code == 200:
+            pdf_bytes = asyncio.run(generate_pdf_async(state, year, hazard_type))
+            if pdf_bytes:
                 st.success("PDF generated successfully!")
                 st.download_button(
                     label="📥 Download PDF",
-                    data=response.content,
+                    data=pdf_bytes,
                     file_name=f"Audit_Report_{state}_{year}.pdf",
                     mime="application/pdf",
                 )
@@ -2,21 +2,27 @@ import asyncio
 import io
 import os
 import json
+import pickle
+import pathlib
 import sqlite3
-import requests
-from bs4 import BeautifulSoup
+import threading
+import faiss
+import httpx
+from selectolax.lexbor import LexborHTMLParser
+from collections import OrderedDict
 from datetime import datetime
 from functools import lru_cache
+from urllib.parse import quote
 
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import Response, StreamingResponse
 
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 
 # 🔥 Import pure RAG function
-from agent import ask
+from agent import PartialAnswer, ask, ask_batch, ask_stream, atomic_write, embed
 from rss_feed import fetch_dgms_updates
 
 # ------------------ Setup ------------------
@@ -30,25 +36,54 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Shared async HTTP client: keep-alive (HTTP/2) pool for article fetches
+@app.on_event("startup")
+async def open_http_client():
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+    )
+    app.state.http = httpx.AsyncClient(
+        timeout=10, transport=transport, follow_redirects=True
+    )
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await app.state.http.aclose()
+
 # ------------------ L1 In-Memory Cache ------------------
 # Simple LRU cache for recent queries
 L1_CACHE_SIZE = 100
-lru_cache_store = {}
+lru_cache_store = OrderedDict()
+l1_lock = threading.Lock()
 
 def get_from_l1(query):
-    return lru_cache_store.get(query)
+    with l1_lock:
+        if query in lru_cache_store:
+            # Promote on hit so eviction follows recency, not insertion
+            lru_cache_store.move_to_end(query)
+            return lru_cache_store[query]
+    return None
 
 def set_to_l1(query, response):
-    if len(lru_cache_store) >= L1_CACHE_SIZE:
-        # Remove the least recently used item
-        oldest_key = next(iter(lru_cache_store))
-        lru_cache_store.pop(oldest_key)
-    lru_cache_store[query] = response
+    with l1_lock:
+        lru_cache_store[query] = response
+        lru_cache_store.move_to_end(query)
+        if len(lru_cache_store) > L1_CACHE_SIZE:
+            # Remove the least recently used item
+            lru_cache_store.popitem(last=False)
 
 # ------------------ L2 SQLite Cache ------------------
 DB_PATH = "rag_cache.db"
 conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+db_lock = threading.Lock()
 cursor = conn.cursor()
+# WAL + synchronous=NORMAL: commits append to the log without a full fsync
+cursor.execute("PRAGMA journal_mode=WAL")
+cursor.execute("PRAGMA synchronous=NORMAL")
+cursor.execute("PRAGMA temp_store=MEMORY")
+cursor.execute("PRAGMA mmap_size=268435456")
 cursor.execute("""
 CREATE TABLE IF NOT EXISTS cache (
     query TEXT PRIMARY KEY,
@@ -59,39 +94,171 @@ CREATE TABLE IF NOT EXISTS cache (
 conn.commit()
 
 def get_from_l2(query):
-    cursor.execute("SELECT response FROM cache WHERE query = ?", (query,))
-    row = cursor.fetchone()
+    with db_lock:
+        row = conn.execute("SELECT response FROM cache WHERE query = ?", (query,)).fetchone()
     if row:
         return row[0]
     return None
 
+def set_many_to_l2(rows):
+    # Insert and commit in one short transaction, so SQLite's write lock is
+    # never held open across a Gemini call (other workers would block on it)
+    with db_lock, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO cache (query, response, timestamp) VALUES (?, ?, CURRENT_TIMESTAMP)",
+            rows
+        )
+
 def set_to_l2(query, response):
-    cursor.execute(
-        "INSERT OR REPLACE INTO cache (query, response, timestamp) VALUES (?, ?, CURRENT_TIMESTAMP)",
-        (query, response)
-    )
-    conn.commit()
+    set_many_to_l2([(query, response)])
+
+# ------------------ L3 Semantic Cache ------------------
+# Answers keyed by query embedding; a near-duplicate query (cosine >= τ)
+# reuses the cached answer instead of another Gemini round-trip.
+SEM_DIM = 384  # all-MiniLM-L6-v2
+SEM_PERSIST_EVERY = 20
+# Bound the flat scan and the snapshot size; when full, the oldest
+# SEM_EVICT_FRACTION of entries is dropped in one compaction.
+SEM_MAX_ENTRIES = 5000
+SEM_EVICT_FRACTION = 0.1
+
+class SemanticCache:
+    """Embedding-similarity cache for one endpoint.
+
+    Each endpoint gets its own index and file, so an entry can only ever
+    answer queries from the endpoint that produced it. Vectors and answers
+    are persisted together so row i always matches answer i.
+    """
+
+    def __init__(self, name, threshold):
+        self.path = pathlib.Path(f"sem_cache_{name}.pkl")
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        # Serializes snapshots so an older one never replaces a newer one
+        self.persist_lock = threading.Lock()
+        self.index, self.answers = self._load()
+        self.unsaved = 0
+
+    def _load(self):
+        index = faiss.IndexFlatIP(SEM_DIM)
+        if not self.path.exists():
+            return index, []
+        try:
+            with open(self.path, "rb") as f:
+                snapshot = pickle.load(f)
+            vectors, answers = snapshot["vectors"], snapshot["answers"]
+            if vectors.shape != (len(answers), SEM_DIM):
+                raise ValueError(f"{vectors.shape[0]} vectors vs {len(answers)} answers")
+        except Exception as e:
+            print(f"⚠️ Ignoring unusable semantic cache {self.path} ({e})")
+            return index, []
+        index.add(vectors[-SEM_MAX_ENTRIES:])
+        return index, list(answers[-SEM_MAX_ENTRIES:])
+
+    def persist(self):
+        with self.persist_lock:
+            with self.lock:
+                snapshot = {
+                    "vectors": self.index.reconstruct_n(0, self.index.ntotal),
+                    "answers": list(self.answers),
+                }
+                self.unsaved = 0
+
+            def write(tmp):
+                with open(tmp, "wb") as f:
+                    pickle.dump(snapshot, f)
+
+            atomic_write(self.path, write)
+
+    def get(self, q_emb):
+        with self.lock:
+            if self.index.ntotal == 0:
+                return None
+            D, I = self.index.search(q_emb, 1)
+            if I[0, 0] != -1 and D[0, 0] >= self.threshold:
+                return self.answers[I[0, 0]]
+        return None
+
+    def set(self, q_emb, response):
+        with self.lock:
+            if self.index.ntotal >= SEM_MAX_ENTRIES:
+                n_drop = max(1, int(SEM_MAX_ENTRIES * SEM_EVICT_FRACTION))
+                # Flat index ids are positions, so this keeps rows and answers aligned
+                self.index.remove_ids(faiss.IDSelectorRange(0, n_drop))
+                del self.answers[:n_drop]
+            self.index.add(q_emb)
+            self.answers.append(response)
+            self.unsaved += 1
+            due = self.unsaved >= SEM_PERSIST_EVERY
+        if due:
+            try:
+                self.persist()
+            except OSError as e:
+                # A failed snapshot must not turn an answered request into an error
+                print(f"⚠️ Could not persist semantic cache {self.path} ({e})")
+
+# Semantic layer per endpoint; None means exact-match (L1/L2) only.
+# /updates and /audit prompts are mostly fixed template text: two different
+# circulars (or audit parameter sets) differ only in a title/date/link or
+# state/year, easily clearing any useful cosine threshold, so they would be
+# served each other's analysis.
+query_sem_cache = SemanticCache("query", threshold=0.92)
+updates_sem_cache = None
+audit_sem_cache = None
+
+@app.on_event("shutdown")
+def save_sem_cache():
+    if query_sem_cache.unsaved:
+        query_sem_cache.persist()
 
 # ------------------ Cached RAG ------------------
-async def cached_ask(query: str):
+async def lookup_cached(query: str, sem=query_sem_cache):
+    """Return (cached answer or None, query embedding or None)."""
     # Check L1
     result = get_from_l1(query)
     if result:
-        return result
+        return result, None
 
     # Check L2
-    result = get_from_l2(query)
+    result = await asyncio.to_thread(get_from_l2, query)
     if result:
         set_to_l1(query, result)  # Promote to L1
+        return result, None
+
+    # Check L3 (semantic)
+    q_emb = None
+    if sem is not None:
+        q_emb = await asyncio.to_thread(embed, query)
+        result = sem.get(q_emb)
+        if result:
+            set_to_l1(query, result)
+            return result, q_emb
+
+    return None, q_emb
+
+def store_results(results, sem=None):
+    """Save (query, result_str, q_emb) triples to all caches; one L2 commit."""
+    set_many_to_l2([(query, result_str) for query, result_str, _ in results])
+    for query, result_str, q_emb in results:
+        set_to_l1(query, result_str)
+        if sem is not None and q_emb is not None:
+            sem.set(q_emb, result_str)
+
+def store_result(query, result_str, q_emb=None, sem=None):
+    store_results([(query, result_str, q_emb)], sem)
+
+async def cached_ask(query: str, sem=query_sem_cache):
+    result, q_emb = await lookup_cached(query, sem)
+    if result:
         return result
 
     # Miss → Call RAG
     result = await asyncio.to_thread(ask, query)
     result_str = str(result).strip()
+    if isinstance(result, PartialAnswer):
+        return result_str  # cut off at the output limit: return, don't cache
 
-    # Save to both caches
-    set_to_l2(query, result_str)
-    set_to_l1(query, result_str)
+    await asyncio.to_thread(store_result, query, result_str, q_emb, sem)
     return result_str
 
 # ------------------ QUERY ENDPOINT ------------------
@@ -102,51 +269,151 @@ async def query_agent(request: Request):
     if not query:
         return {"response": "⚠️ Query is empty."}
 
-    response = await cached_ask(query)
+    try:
+        response = await cached_ask(query)
+    except Exception as e:
+        return {"response": f"⚠️ Error: {e}"}
     return {"response": response}
 
+def sse_event(text):
+    return f"data: {json.dumps(text)}\n\n"
+
+@app.post("/query/stream")
+async def query_agent_stream(request: Request):
+    data = await request.json()
+    query = data.get("query", "")
+    if not query:
+        return StreamingResponse(iter([sse_event("⚠️ Query is empty.")]), media_type="text/event-stream")
+
+    result, q_emb = await lookup_cached(query)
+    if result:
+        return StreamingResponse(iter([sse_event(result)]), media_type="text/event-stream")
+
+    # Sync generator: Starlette iterates it in the threadpool
+    def token_generator():
+        parts = []
+        try:
+            for text in ask_stream(query):
+                if isinstance(text, PartialAnswer):
+                    return  # cut off at the output limit: shown, not cached
+                parts.append(text)
+                yield sse_event(text)
+        except Exception as e:
+            # Failed answer: tell the client, cache nothing
+            yield sse_event(f"\n\n⚠️ Error: {e}")
+            return
+        # Cache only the fully-assembled answer
+        store_result(query, "".join(parts).strip(), q_emb, query_sem_cache)
+
+    return StreamingResponse(token_generator(), media_type="text/event-stream")
+
 # ------------------ DGMS UPDATES ENDPOINT ------------------
+MAX_ARTICLE_BYTES = 512 * 1024
+
+async def fetch_article_html(link):
+    # Stream and stop early; only the first few <p> tags are used anyway
+    async with app.state.http.stream("GET", link) as response:
+        chunks, size = [], 0
+        async for chunk in response.aiter_bytes(chunk_size=16 * 1024):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= MAX_ARTICLE_BYTES:
+                break
+        return b"".join(chunks).decode(response.encoding or "utf-8", errors="replace")
+
+def extract_paragraphs(html, limit=5):
+    # selectolax (lexbor, C) instead of BeautifulSoup's Python tree building
+    return [node.text() for node in LexborHTMLParser(html).css("p")[:limit]]
+
+UPDATE_ANALYSIS_FORMAT = (
+    'an object with keys "risk" (High, Medium, Low, or None), '
+    '"hazard" (the hazard type) and "analysis" (a short explanation).'
+)
+
+async def build_update_prompt(item):
+    title = item.get("title", "")
+    link = item.get("link", "")
+    published = item.get("published", "")
+
+    try:
+        html = await fetch_article_html(link)
+        paragraphs = await asyncio.to_thread(extract_paragraphs, html)
+        content = " ".join(paragraphs) if paragraphs else "(No text found.)"
+    except Exception:
+        content = "(Could not fetch full article text.)"
+
+    return (
+        f"You are a mining safety officer. Analyze the following DGMS update "
+        f"and classify the risk level (High, Medium, Low, or None), and describe "
+        f"the hazard type.\n\n"
+        f"Title: {title}\nPublished: {published}\nLink: {link}\n"
+        f"Content: {content}"
+    )
+
+def format_update_analysis(entry):
+    return (
+        f"**Risk level:** {entry.get('risk', 'Unknown')}\n\n"
+        f"**Hazard type:** {entry.get('hazard', 'Unknown')}\n\n"
+        f"{entry.get('analysis', '')}"
+    ).strip()
+
+async def analyze_update(prompt):
+    try:
+        return await cached_ask(prompt, sem=updates_sem_cache)
+    except Exception as e:
+        return f"⚠️ Error: {e}"
+
 @app.get("/updates")
 async def get_dgms_updates():
     updates = fetch_dgms_updates(limit=5)
 
-    async def analyze_update(item):
-        title = item.get("title", "")
-        link = item.get("link", "")
-        published = item.get("published", "")
+    prompts = await asyncio.gather(*[build_update_prompt(u) for u in updates])
+    lookups = await asyncio.gather(
+        *[lookup_cached(p, updates_sem_cache) for p in prompts]
+    )
+    outputs = [result for result, _ in lookups]
 
+    # All cache misses go to Gemini together: one round-trip instead of N
+    misses = [i for i, output in enumerate(outputs) if not output]
+    if misses:
+        miss_prompts = [prompts[i] for i in misses]
+        miss_embs = [lookups[i][1] for i in misses]
         try:
-            response = await asyncio.to_thread(requests.get, link, timeout=10)
-            soup = BeautifulSoup(response.text, "html.parser")
-            paragraphs = [p.get_text() for p in soup.find_all("p")]
-            content = " ".join(paragraphs[:5]) if paragraphs else "(No text found.)"
+            entries = await asyncio.to_thread(
+                ask_batch, miss_prompts, UPDATE_ANALYSIS_FORMAT, miss_embs
+            )
+            analyses = [format_update_analysis(entry) for entry in entries]
         except Exception:
-            content = "(Could not fetch full article text.)"
-
-        prompt = (
-            f"You are a mining safety officer. Analyze the following DGMS update "
-            f"and classify the risk level (High, Medium, Low, or None), and describe "
-            f"the hazard type.\n\n"
-            f"Title: {title}\nPublished: {published}\nLink: {link}\n"
-            f"Content: {content}"
-        )
-
-        try:
-            output = await cached_ask(prompt)
-        except Exception as e:
-            output = f"⚠️ Error: {e}"
-
-        return {
-            "title": title,
-            "link": link,
-            "published": published,
+            # Malformed batch reply → fall back to one call per update
+            analyses = await asyncio.gather(*[analyze_update(p) for p in miss_prompts])
+        else:
+            # Cache per item so single-update lookups still hit; one transaction
+            await asyncio.to_thread(
+                store_results, list(zip(miss_prompts, analyses, miss_embs)), updates_sem_cache
+            )
+        for i, analysis in zip(misses, analyses):
+            outputs[i] = analysis
+
+    analyzed_updates = [
+        {
+            "title": item.get("title", ""),
+            "link": item.get("link", ""),
+            "published": item.get("published", ""),
             "danger_analysis": output,
         }
-
-    analyzed_updates = await asyncio.gather(*[analyze_update(u) for u in updates])
+        for item, output in zip(updates, outputs)
+    ]
     return {"updates": analyzed_updates}
 
 # ------------------ AUDIT REPORT PDF ENDPOINT ------------------
+PDF_LINE_WIDTH = 90
+
+def wrap_line(line, width=PDF_LINE_WIDTH):
+    # Fixed-width slices by offset; avoids re-copying the remainder each step
+    if not line:
+        return [""]
+    return [line[start:start + width] for start in range(0, len(line), width)]
+
 @app.post("/audit_report_pdf")
 async def generate_audit_report_pdf(request: Request):
     data = await request.json()
@@ -169,7 +436,7 @@ async def generate_audit_report_pdf(request: Request):
     )
 
     try:
-        report_text = await cached_ask(prompt)
+        report_text = await cached_ask(prompt, sem=audit_sem_cache)
     except Exception as e:
         report_text = f"⚠️ Error generating report: {e}"
 
@@ -189,29 +456,22 @@ async def generate_audit_report_pdf(request: Request):
     y = height - 160
     c.setFont("Helvetica", 11)
     for line in report_text.splitlines():
-        while len(line) > 90:
-            part = line[:90]
+        for part in wrap_line(line):
             c.drawString(60, y, part)
             y -= 15
-            line = line[90:]
-        c.drawString(60, y, line)
-        y -= 15
-        if y < 50:
-            c.showPage()
-            y = height - 50
-            c.setFont("Helvetica", 11)
+            if y < 50:
+                c.showPage()
+                y = height - 50
+                c.setFont("Helvetica", 11)
 
     c.save()
-    pdf_buffer.seek(0)
 
+    # Serve straight from memory; no temp file on disk
     filename = f"Audit_Report_{state}_{year}.pdf"
-    with open(filename, "wb") as f:
-        f.write(pdf_buffer.getvalue())
-
-    return FileResponse(
-        path=filename,
-        filename=filename,
-        media_type="application/pdf"
+    return Response(
+        content=pdf_buffer.getvalue(),
+        media_type="application/pdf",
+        headers={"Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}"},
     )
 
 @app.get("/")